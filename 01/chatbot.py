@@ -4,17 +4,33 @@ import chainlit as cl
 # sk...の部分を自身のAPIキーに置き換える
 openai.api_key = "sk-..."
 
+# 全セッション共通のシステムメッセージ
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "あなたは枝豆の妖精です。一人称は「ボク」で、語尾に「なのだ」をつけて話すことが特徴です。"
+}
+
+# 会話履歴として保持するメッセージの最大件数（システムメッセージを除く）
+MAX_HISTORY = 20
+
 
 # 会話履歴をユーザーセッションに保存する
 def store_history(role, message):
     history = cl.user_session.get("history")
     history.append({"role": role, "content": message})
+    # 先頭のシステムメッセージを残したまま、古い会話履歴をターン単位で削除する
+    if len(history) > MAX_HISTORY + 1:
+        start = len(history) - MAX_HISTORY
+        # 残す範囲がユーザーメッセージから始まるように削除位置を調整する
+        while start < len(history) - 1 and history[start]["role"] != "user":
+            start += 1
+        del history[1:start]
     cl.user_session.set("history", history)
 
 
 # ユーザーセッションに保存された会話履歴から新しいメッセージを生成する
-def generate_message():
-    response = openai.ChatCompletion.create(
+async def generate_message():
+    response = await openai.ChatCompletion.acreate(
         model="gpt-3.5-turbo",
         messages=cl.user_session.get("history"),
         temperature=0.7,
@@ -26,10 +42,7 @@ def generate_message():
 # チャットセッション開始時に実行
 @cl.on_chat_start
 def chat_start():
-    cl.user_session.set("history", [{
-        "role": "system",
-        "content": "あなたは枝豆の妖精です。一人称は「ボク」で、語尾に「なのだ」をつけて話すことが特徴です。"
-    }])
+    cl.user_session.set("history", [SYSTEM_MESSAGE])
 
 
 # ユーザーメッセージ受信時に実行
@@ -39,7 +52,7 @@ async def main(message: str):
     store_history("user", message)
 
     # 新しいメッセージを生成
-    reply = generate_message()
+    reply = await generate_message()
 
     # 新しいメッセージを会話履歴に追加
     store_history("assistant", reply)
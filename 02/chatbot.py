@@ -2,6 +2,7 @@ import openai
 import chainlit as cl
 import chromadb
 from chromadb.utils import embedding_functions
+from functools import cache, lru_cache
 
 # sk...の部分を自身のAPIキーに置き換える
 # openai.api_key = "sk-..."
@@ -21,16 +22,26 @@ SYSTEM_MESSAGE = f"""あなたは以下のリストに完全に従って行動
 ・必ず一人称は「ボク」で、語尾に「なのだ」をつけて話してください。
 """
 
+# 会話履歴として保持するメッセージの最大件数（システムメッセージを除く）
+MAX_HISTORY = 20
+
 
 # 会話履歴をユーザーセッションに保存する
 def store_history(role: str, message: str) -> None:
     history = cl.user_session.get("history")
     history.append({"role": role, "content": message})
+    # 先頭のシステムメッセージを残したまま、古い会話履歴をターン単位で削除する
+    if len(history) > MAX_HISTORY + 1:
+        start = len(history) - MAX_HISTORY
+        # 残す範囲がユーザーメッセージから始まるように削除位置を調整する
+        while start < len(history) - 1 and history[start]["role"] != "user":
+            start += 1
+        del history[1:start]
     cl.user_session.set("history", history)
 
 
 # ユーザーセッションに保存された会話履歴から新しいメッセージを生成する
-def generate_message(temperature: float = 0.7, max_tokens: int = 300) -> (str, str):
+async def generate_message(temperature: float = 0.7, max_tokens: int = 300) -> (str, str):
     relevant = ""
 
     # ユーザーセッションから会話履歴を取得
@@ -42,7 +53,8 @@ def generate_message(temperature: float = 0.7, max_tokens: int = 300) -> (str, s
         user_message = messages[-1]['content']
 
         # ユーザーの質問に関する関連情報を取得
-        relevant = relevant_information_prompt(user_message)
+        # （埋め込みAPIとベクトル検索は同期処理のため、別スレッドで実行する）
+        relevant = await cl.make_async(relevant_information_prompt)(user_message)
 
         # 関連情報がある場合、システムメッセージを追加する
         if len(relevant) > 0:
@@ -52,7 +64,7 @@ def generate_message(temperature: float = 0.7, max_tokens: int = 300) -> (str, s
             })
 
     # ChatGPTにリクエストしてレスポンスを受け取る
-    response = openai.ChatCompletion.create(
+    response = await openai.ChatCompletion.acreate(
         model="gpt-3.5-turbo",
         messages=messages,
         temperature=temperature,
@@ -61,25 +73,43 @@ def generate_message(temperature: float = 0.7, max_tokens: int = 300) -> (str, s
     return response.choices[0].message.content, relevant
 
 
-def relevant_information_prompt(user_message: str) -> str:
-    # ユーザーセッションからコレクションを取得
-    collection = cl.user_session.get('collection')
+# Chromaのコレクションは全セッションで共有できるため、初回のみ取得して使い回す
+@cache
+def get_collection() -> chromadb.Collection:
+    # dataディレクトリを指定してChromaクライアントを取得
+    client = chromadb.PersistentClient(path="./data")
+
+    # コレクションを取得
+    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
+        model_name="text-embedding-ada-002"
+    )
+    return client.get_collection(
+        'events_2023', embedding_function=openai_ef
+    )
+
 
+# 同じ質問の関連情報は変わらないため、結果をキャッシュして埋め込みAPIの呼び出しを省く
+@lru_cache(maxsize=128)
+def relevant_information_prompt(user_message: str) -> str:
     # ユーザーの質問に関する関連情報を取得
-    result = collection.query(
+    result = get_collection().query(
         query_texts=[user_message],
         n_results=5
     )
 
-    # distanceの配列から0.4以下のインデックス番号を配列で取得
-    indexes = [i for i, d in enumerate(result['distances'][0]) if d <= 0.4]
+    # distanceが0.4以下のドキュメントだけを一度に抽出
+    documents = [
+        document
+        for document, distance in zip(result['documents'][0], result['distances'][0])
+        if distance <= 0.4
+    ]
 
     # 関連情報がない場合は空文字を返す
-    if len(indexes) == 0:
+    if len(documents) == 0:
         return ""
 
     # 関連情報がある場合は、関連情報プロンプトを返す
-    events = "\n\n".join([f"{event}" for event in result['documents'][0]])
+    events = "\n\n".join(documents)
     prompt = f"""
 ユーザーからの質問に対して、以下の関連情報を基に回答してください。
 
@@ -96,20 +126,6 @@ def chat_start() -> None:
         "history", [{"role": "system", "content": SYSTEM_MESSAGE}]
     )
 
-    # dataディレクトリを指定してChromaクライアントを取得
-    client = chromadb.PersistentClient(path="./data")
-
-    # コレクションを取得
-    openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-        model_name="text-embedding-ada-002"
-    )
-    collection = client.get_collection(
-        'events_2023', embedding_function=openai_ef
-    )
-
-    # ユーザーセッションにコレクションを保存
-    cl.user_session.set('collection', collection)
-
 
 # ユーザーメッセージ受信時に実行
 @cl.on_message
@@ -118,7 +134,7 @@ async def main(message: str) -> None:
     store_history("user", message)
 
     # 新しいメッセージを生成
-    reply, relevant = generate_message(max_tokens=1000)
+    reply, relevant = await generate_message(max_tokens=1000)
 
     # 関連情報がある場合は、会話履歴に関連情報を追加
     if len(relevant) > 0:
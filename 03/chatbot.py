@@ -4,6 +4,7 @@ from langchain.chains import RetrievalQAWithSourcesChain
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.memory import ConversationBufferMemory
+from functools import cache
 import chainlit as cl
 
 # sk...の部分を自身のAPIキーに置き換える
@@ -27,6 +28,29 @@ SYSTEM_MESSAGE = f"""あなたは以下のリストに完全に従って行動
 ----------------
 {{summaries}}"""
 
+# チャットプロンプトはセッションごとに変わらないため、起動時に一度だけ作成する
+PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_MESSAGE),
+    ("human", "{question}")
+])
+
+
+# LLMクライアントはセッション間で共有し、接続を使い回す
+@cache
+def get_llm() -> ChatOpenAI:
+    return ChatOpenAI(temperature=0.0)
+
+
+# データ抽出元のベクトルデータベースの設定（初回のみ作成し、以降は使い回す）
+@cache
+def get_docsearch() -> Chroma:
+    embeddings = OpenAIEmbeddings()
+    return Chroma(
+        persist_directory="./data",
+        collection_name="events_2023",
+        embedding_function=embeddings
+    )
+
 
 # チャットセッション開始時に実行
 @cl.on_chat_start
@@ -38,26 +62,14 @@ def chat_start() -> None:
         output_key='answer',
         return_messages=True
     )
-    # チャットプロンプトを作成
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", SYSTEM_MESSAGE),
-        ("human", "{question}")
-    ])
-    # データ抽出元のベクトルデータベースの設定
-    embeddings = OpenAIEmbeddings()
-    docsearch = Chroma(
-        persist_directory="./data",
-        collection_name="events_2023",
-        embedding_function=embeddings
-    )
     # データソースから関連情報を抽出して返すチェインを定義
     chain = RetrievalQAWithSourcesChain.from_chain_type(
-        ChatOpenAI(temperature=0.0),
+        get_llm(),
         chain_type="stuff",
-        retriever=docsearch.as_retriever(),
+        retriever=get_docsearch().as_retriever(),
         memory=memory,
         return_source_documents=True,
-        chain_type_kwargs={"prompt": prompt},
+        chain_type_kwargs={"prompt": PROMPT},
     )
     # ユーザーセッションにチェインを保存
     cl.user_session.set("chain", chain)
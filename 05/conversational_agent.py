@@ -1,3 +1,4 @@
+import asyncio
 from typing import Dict, Any, Tuple, Generator
 from langchain.schema.agent import AgentFinish
 from langchain.tools.render import format_tool_to_openai_function
@@ -7,9 +8,11 @@ from langchain.schema.output_parser import StrOutputParser
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chat_models import ChatOpenAI
 from langchain.agents.agent_toolkits import FileManagementToolkit
-from langchain.memory import ConversationBufferMemory
+from langchain.tools import BaseTool
+from langchain.memory import ConversationBufferWindowMemory
 from openai import BadRequestError
 from pathlib import Path
+from functools import cache
 
 # NOTE: デバッグの際は以下の行をコメントアウトすると、
 # LangChainのデバッグ用のログが表示されて便利です。
@@ -17,6 +20,47 @@ from pathlib import Path
 # set_debug(True)
 
 MODEL_NAME = "gpt-4"
+# 会話履歴として保持する直近のやり取りの件数
+MAX_HISTORY_TURNS = 10
+SYSTEM_MESSAGE = "You are a useful assistant."
+FALLBACK_SYSTEM_MESSAGE = ("You are the AI that tells the user what the error is in plain Japanese. "
+                           "Since the error occurs at the end of the step, you must guess from the process flow "
+                           "and the error message, and communicate the error message to the user in an easy-to-understand manner.")
+
+
+# プロンプトはセッションごとに変わらないため、起動時に一度だけ作成する
+def build_prompt(system_message: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages([
+        ("system", system_message),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("user", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad")
+    ])
+
+
+PROMPT = build_prompt(SYSTEM_MESSAGE)
+FALLBACK_PROMPT = build_prompt(FALLBACK_SYSTEM_MESSAGE)
+
+
+# LLMクライアントはセッション間で共有し、接続を使い回す
+@cache
+def get_llm() -> ChatOpenAI:
+    return ChatOpenAI(temperature=0, model=MODEL_NAME)
+
+
+# ファイル操作ツールは状態を持たないため、作業ディレクトリごとに一度だけ作成して使い回す
+@cache
+def load_file_tools(root_dir: str) -> Tuple[BaseTool, ...]:
+    return tuple(FileManagementToolkit(
+        root_dir=root_dir,
+        selected_tools=["read_file", "write_file", "list_directory"]
+    ).get_tools())
+
+
+# ツールのfunction定義（JSONスキーマ）への変換も、作業ディレクトリごとに一度だけ行う
+@cache
+def load_tool_functions(root_dir: str) -> Tuple[Dict[str, Any], ...]:
+    return tuple(format_tool_to_openai_function(t) for t in load_file_tools(root_dir))
 
 
 class ConversationalAgent:
@@ -25,40 +69,30 @@ class ConversationalAgent:
         self.intermediate_steps = []
         self.working_directory = working_directory
         self.tools = self.setup_tools()
+        self.tool_map = {tool.name: tool for tool in self.tools}
         self.memory = self.setup_memory()
 
-        llm = ChatOpenAI(temperature=0, model=MODEL_NAME)
+        llm = get_llm()
 
         # ③ ツールプールの定義
         llm_with_tools = llm.bind(
-            functions=[format_tool_to_openai_function(t) for t in self.tools])
+            functions=list(load_tool_functions(str(self.working_directory.name))))
 
         self.agent_chain = self.setup_chain(llm_with_tools, is_fallback=False)
         self.fallback_chain = self.setup_chain(llm, is_fallback=True)
 
     # ①-1 プロンプトの定義
     def create_prompt(self, is_fallback: bool) -> ChatPromptTemplate:
-        system_message = ("You are the AI that tells the user what the error is in plain Japanese. "
-                          "Since the error occurs at the end of the step, you must guess from the process flow "
-                          "and the error message, and communicate the error message to the user in an easy-to-understand manner.") \
-            if is_fallback else "You are a useful assistant."
-        return ChatPromptTemplate.from_messages([
-            ("system", system_message),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("user", "{input}"),
-            MessagesPlaceholder(variable_name="agent_scratchpad")
-        ])
+        return FALLBACK_PROMPT if is_fallback else PROMPT
 
     # ①-2 ツールの定義
-    def setup_tools(self) -> Dict[str, Any]:
-        return FileManagementToolkit(
-            root_dir=str(self.working_directory.name),
-            selected_tools=["read_file", "write_file", "list_directory"]
-        ).get_tools()
+    def setup_tools(self) -> Tuple[BaseTool, ...]:
+        return load_file_tools(str(self.working_directory.name))
 
     # ①-3 メモリの定義
-    def setup_memory(self) -> ConversationBufferMemory:
-        return ConversationBufferMemory(memory_key="chat_history", return_messages=True)
+    def setup_memory(self) -> ConversationBufferWindowMemory:
+        return ConversationBufferWindowMemory(
+            memory_key="chat_history", k=MAX_HISTORY_TURNS, return_messages=True)
 
     # ①-4 チェインの定義
     def setup_chain(self, llm: ChatOpenAI, is_fallback: bool) -> Any:
@@ -92,22 +126,18 @@ class ConversationalAgent:
             if isinstance(output, AgentFinish):
                 return output.return_values["output"], True
             else:
-                observation = self.tool_execute(output.tool, output.tool_input)
+                # ファイル操作ツールは同期処理のため、別スレッドで実行してイベントループを塞がない
+                observation = await asyncio.to_thread(self.tool_execute, output.tool, output.tool_input)
                 message = self.format_tool_log(
                     output.tool, output.tool_input, observation)
                 self.intermediate_steps.append((output, observation))
                 return message, False
         except BadRequestError as error:
-            return self.handle_error(error), True
+            return await self.handle_error(error), True
 
     # ②-2 ツールの選択／実行
     def tool_execute(self, tool_name: str, tool_input: Dict[str, Any]) -> str:
-        read_file, write_file, list_directory = self.tools
-        tool = {
-            "read_file": read_file,
-            "write_file": write_file,
-            "list_directory": list_directory,
-        }.get(tool_name)
+        tool = self.tool_map.get(tool_name)
         if tool:
             return tool.run(tool_input)
         else:
@@ -120,10 +150,10 @@ class ConversationalAgent:
         self.intermediate_steps = []
 
     # エラー処理
-    def handle_error(self, error: BadRequestError) -> str:
+    async def handle_error(self, error: BadRequestError) -> str:
         # コンテキスト長あふれの可能性もあるため、最後のステップのツール実行結果を空にする
         self.intermediate_steps[-1] = (self.intermediate_steps[-1][0], "")
-        return self.fallback_chain.invoke({
+        return await self.fallback_chain.ainvoke({
             "input": error.response.json()["error"]["message"],
             "intermediate_steps": self.intermediate_steps
         })